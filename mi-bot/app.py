@@ -1,8 +1,9 @@
 from flask import Flask, request
 import os
 import cohere
+import httpx
 import logging
-import json
+import orjson
 import random
 import re
 import threading
@@ -10,11 +11,23 @@ import unicodedata
 from dotenv import load_dotenv
 from waitress import serve
 import psycopg2
-from cohere.errors import NotFoundError
+from psycopg2 import pool
+from psycopg2.extras import execute_values, register_default_jsonb
+from contextlib import contextmanager
+from cachetools import TTLCache
+from collections import deque
+import redis
+from cohere.errors import ForbiddenError, NotFoundError, UnauthorizedError
 from datetime import datetime
-import requests
 import ast
 import time
+import hashlib
+import queue
+import atexit
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import ahocorasick
 
 # --- CONFIGURACIÓN ---
 load_dotenv()
@@ -22,43 +35,167 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(
 
 # --- ADMINISTRADOR DE API KEYS ---
 class ApiKeyManager:
-    def __init__(self, api_keys):
+    """
+    Reparte las llamadas entre todas las llaves: cada llamada va a la llave con
+    menos llamadas en curso y, a igualdad, a la que viene respondiendo más
+    rápido (media móvil de latencia). Cada llave tiene un máximo de llamadas
+    simultáneas, y una llave que falla queda en enfriamiento mientras tanto.
+    """
+    LATENCY_EMA_ALPHA = 0.2
+
+    def __init__(self, api_keys, per_key_concurrency, cooldown_seconds, http_client=None):
         if not api_keys:
             raise ValueError("No hay API keys de Cohere configuradas.")
         self.keys = api_keys
-        self.current_index = 0
+        # Un cliente persistente por llave; todos comparten el mismo pool HTTP si se pasa uno
+        self.clients = [cohere.Client(api_key=api_key, httpx_client=http_client) for api_key in api_keys]
+        self.semaphores = [threading.BoundedSemaphore(per_key_concurrency) for _ in api_keys]
+        self.cooldown_until = [0.0] * len(api_keys)
+        self.cooldown_seconds = cooldown_seconds
+        self.in_flight = [0] * len(api_keys)
+        self.latency_ema = [0.0] * len(api_keys)
         self.lock = threading.Lock()
         logging.info(f"Se cargaron {len(self.keys)} llaves de API de Cohere.")
 
-    def get_current_client(self):
-        api_key = self.keys[self.current_index]
-        return cohere.Client(api_key=api_key)
+    def next_index(self, exclude=()):
+        """Elige la llave y la cuenta como ocupada (se libera en lease)."""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [i for i in range(len(self.keys))
+                          if i not in exclude and self.cooldown_until[i] <= now]
+            if candidates:
+                index = min(candidates, key=lambda i: (self.in_flight[i], self.latency_ema[i]))
+            else:
+                # Todas en enfriamiento (o excluidas): se usa la que se libera antes
+                candidates = [i for i in range(len(self.keys)) if i not in exclude] or range(len(self.keys))
+                index = min(candidates, key=self.cooldown_until.__getitem__)
+            self.in_flight[index] += 1
+            return index
+
+    @contextmanager
+    def lease(self, exclude=()):
+        """Entrega (índice, cliente) de la llave elegida y ocupa uno de sus cupos."""
+        index = self.next_index(exclude)
+        try:
+            with self.semaphores[index]:
+                yield index, self.clients[index]
+        finally:
+            with self.lock:
+                self.in_flight[index] -= 1
 
-    def rotate_to_next_key(self):
+    def mark_success(self, index, elapsed):
         with self.lock:
-            self.current_index = (self.current_index + 1) % len(self.keys)
-            logging.warning(f"Cambiando a la API key #{self.current_index + 1}")
-        return self.get_current_client()
+            ema = self.latency_ema[index]
+            self.latency_ema[index] = elapsed if ema == 0.0 else ema + self.LATENCY_EMA_ALPHA * (elapsed - ema)
+
+    def mark_failed(self, index, retry_after=None):
+        cooldown = retry_after if retry_after is not None else self.cooldown_seconds
+        with self.lock:
+            self.cooldown_until[index] = time.monotonic() + cooldown
+        logging.warning(f"API key #{index + 1} en enfriamiento por {cooldown}s")
+
+    def disable(self, index):
+        """Una llave rechazada (revocada o sin permisos) no vuelve a elegirse mientras haya otras."""
+        with self.lock:
+            self.cooldown_until[index] = float("inf")
+        logging.error(f"API key #{index + 1} rechazada por Cohere, queda deshabilitada.")
 
 # --- INICIALIZAR COHERE ---
 cohere_api_keys_env = os.getenv("COHERE_API_KEYS", "")
 cohere_keys = [k.strip() for k in cohere_api_keys_env.split(",") if k.strip()]
 if not cohere_keys:
     raise ValueError("No se encontraron API keys en COHERE_API_KEYS")
-key_manager = ApiKeyManager(cohere_keys)
+COHERE_KEY_CONCURRENCY = int(os.getenv("COHERE_KEY_CONCURRENCY", 10))
+COHERE_KEY_COOLDOWN = 30  # segundos
+COHERE_HTTP_TIMEOUT = 300  # segundos, el mismo que usa el SDK por defecto
+# Un solo pool de conexiones para todas las llaves: las conexiones TLS a la API
+# de Cohere siguen calientes aunque las llamadas vayan cambiando de llave
+cohere_http_client = httpx.Client(
+    timeout=COHERE_HTTP_TIMEOUT,
+    follow_redirects=True,
+    limits=httpx.Limits(max_connections=None, max_keepalive_connections=64, keepalive_expiry=30),
+)
+key_manager = ApiKeyManager(cohere_keys, COHERE_KEY_CONCURRENCY, COHERE_KEY_COOLDOWN, cohere_http_client)
 
 # --- DB ---
 DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("No se encontró la DATABASE_URL en las variables de entorno.")
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+# Las columnas JSONB (el historial) se decodifican con orjson en vez de json
+register_default_jsonb(globally=True, loads=orjson.loads)
+
+# Hilos de waitress: cada chat en curso ocupa uno mientras espera a Cohere,
+# así que este número es el límite de conversaciones simultáneas
+WAITRESS_THREADS = int(os.getenv("WAITRESS_THREADS", 50))
+
+# Las conexiones solo se usan unos milisegundos por turno, así que el pool no
+# necesita una por hilo: los hilos esperan un cupo en vez de recibir PoolError
+DB_POOL_MAX_CONN = int(os.getenv("DB_POOL_MAX_CONN", 20))
+# psycopg2 cierra toda conexión devuelta por encima de minconn: por defecto se
+# mantienen todas abiertas para no reconectar (ni repetir el PREPARE) en cada ráfaga
+DB_POOL_MIN_CONN = min(DB_POOL_MAX_CONN, int(os.getenv("DB_POOL_MIN_CONN", DB_POOL_MAX_CONN)))
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_CONN)
+# Una conexión que lleva más de esto sin usarse se verifica antes de entregarla
+DB_PING_AFTER_IDLE = 30  # segundos
+# Una consulta colgada no debe retener un cupo del pool indefinidamente
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 5000))
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Conexión del pool con el estado que necesitamos guardar por conexión."""
+    get_hist_prepared = False
+    last_used = None  # time.monotonic() de la última devolución al pool
+
+db_pool = pool.ThreadedConnectionPool(
+    minconn=DB_POOL_MIN_CONN, maxconn=DB_POOL_MAX_CONN, dsn=DATABASE_URL,
+    connection_factory=PooledConnection,
+    options=f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}",
+    application_name="tatiana-bot",
+    # Keepalives TCP: detecta conexiones muertas del pool sin esperar al timeout del kernel
+    keepalives=1, keepalives_idle=60, keepalives_interval=10, keepalives_count=3,
+)
+
+def checkout_conn():
+    """
+    Saca una conexión del pool. El pool de psycopg2 ya es LIFO (reutiliza la
+    última devuelta), así que en tráfico normal no se hace ningún ping; solo
+    las conexiones inactivas hace rato se comprueban con un SELECT 1. Tras un
+    reinicio de Postgres todas las inactivas están muertas a la vez, así que se
+    sigue probando (y descartando) hasta dar con una viva o con una nueva.
+    """
+    while True:
+        conn = db_pool.getconn()
+        if conn.last_used is None or time.monotonic() - conn.last_used <= DB_PING_AFTER_IDLE:
+            return conn
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            return conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            logging.warning("Conexión a Postgres caída, se reemplaza por una nueva.")
+            db_pool.putconn(conn, close=True)
+
+@contextmanager
+def db_conn():
+    """Toma una conexión del pool (esperando si están todas ocupadas) y la devuelve al terminar."""
+    with db_pool_slots:
+        conn = checkout_conn()
+        try:
+            # Limpia cualquier transacción abortada que haya quedado de un uso anterior
+            conn.rollback()
+            yield conn
+        finally:
+            conn.last_used = time.monotonic()
+            db_pool.putconn(conn, close=bool(conn.closed))
 
 def init_db():
-    conn = get_db_connection()
-    try:
+    with db_conn() as conn:
         with conn.cursor() as cur:
+            # En un arranque "en caliente" la tabla ya existe: basta una consulta al catálogo
+            cur.execute("SELECT to_regclass('conversation_histories') IS NOT NULL;")
+            if cur.fetchone()[0]:
+                logging.info("Tabla 'conversation_histories' ya existe, se omite el DDL.")
+                return
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS conversation_histories (
                     user_id VARCHAR(255) PRIMARY KEY,
@@ -69,34 +206,177 @@ def init_db():
             """)
             conn.commit()
         logging.info("Tabla 'conversation_histories' verificada/creada exitosamente.")
+
+# --- CACHE DE SESIONES (MEMORIA + REDIS) ---
+SESSION_CACHE_SIZE = 10_000
+SESSION_CACHE_TTL = 900     # segundos en memoria local
+SESSION_REDIS_TTL = 3600    # segundos en Redis
+session_cache = TTLCache(maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL)
+session_cache_lock = threading.Lock()  # TTLCache no es thread-safe
+# Filas aún en la cola del escritor, por usuario: si la cache expulsa la sesión
+# antes de que llegue a Postgres, se lee de aquí y no una versión vieja de la DB
+pending_history_rows = {}
+
+REDIS_URL = os.getenv("REDIS_URL")
+redis_client = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+
+def copy_session(session_data):
+    return {"history": list(session_data["history"]), "emoji_last_message": session_data["emoji_last_message"]}
+
+def get_cached_session(user_id):
+    """Busca la sesión en memoria y luego en Redis. Devuelve None si no está."""
+    with session_cache_lock:
+        cached = session_cache.get(user_id)
+        pending_row = pending_history_rows.get(user_id) if cached is None else None
+    if cached is not None:
+        return copy_session(cached)
+    if pending_row is not None:
+        return {"history": orjson.loads(pending_row[1]), "emoji_last_message": pending_row[2]}
+
+    if redis_client is not None:
+        try:
+            raw = redis_client.get(f"hist:{user_id}")
+        except redis.RedisError as e:
+            logging.warning(f"No se pudo leer la sesión de Redis: {e}")
+            return None
+        if raw:
+            session_data = orjson.loads(raw)
+            with session_cache_lock:
+                session_cache[user_id] = session_data
+            return copy_session(session_data)
+    return None
+
+def cache_session(user_id, session_data):
+    """Actualiza ambas capas de cache después de guardar en la DB."""
+    session_data = copy_session(session_data)
+    with session_cache_lock:
+        session_cache[user_id] = session_data
+    if redis_client is not None:
+        try:
+            redis_client.setex(f"hist:{user_id}", SESSION_REDIS_TTL, orjson.dumps(session_data))
+        except redis.RedisError as e:
+            logging.warning(f"No se pudo guardar la sesión en Redis: {e}")
+
+# --- ESCRITURA DE HISTORIALES EN LOTE ---
+# Las peticiones solo encolan; un hilo agrupa lo que llega en HISTORY_FLUSH_INTERVAL
+# y lo escribe con un único UPSERT multi-fila
+HISTORY_FLUSH_INTERVAL = 0.02  # segundos
+HISTORY_BATCH_MAX = 500
+# Acotada: si Postgres se queda atrás, las peticiones esperan en vez de acumular memoria
+HISTORY_QUEUE_MAX = 10_000
+history_write_queue = queue.Queue(maxsize=HISTORY_QUEUE_MAX)
+
+def flush_history_batch(rows):
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                # El historial no es crítico: no esperamos al flush del WAL en el commit
+                cur.execute("SET LOCAL synchronous_commit = OFF;")
+                execute_values(cur, """
+                    INSERT INTO conversation_histories (user_id, history, emoji_last_message)
+                    VALUES %s
+                    ON CONFLICT (user_id)
+                    DO UPDATE SET history = EXCLUDED.history,
+                                  emoji_last_message = EXCLUDED.emoji_last_message;
+                """, rows, template="(%s, %s::jsonb, %s)", page_size=HISTORY_BATCH_MAX)
+            conn.commit()
+    except Exception as e:
+        logging.error(f"No se pudieron guardar {len(rows)} historiales: {e}", exc_info=True)
     finally:
-        conn.close()
+        # Solo se olvida la fila si no llegó otra más nueva del mismo usuario
+        with session_cache_lock:
+            for row in rows:
+                if pending_history_rows.get(row[0]) is row:
+                    del pending_history_rows[row[0]]
+
+# Se encola al apagar: el escritor termina el lote que tenga en curso y sale
+HISTORY_WRITER_STOP = object()
+
+def history_writer_loop():
+    """Función que se ejecuta en un hilo y vacía la cola de escrituras por lotes."""
+    stopping = False
+    while not stopping:
+        item = history_write_queue.get()
+        if item is HISTORY_WRITER_STOP:
+            break
+        user_id, row = item
+        # Un mismo usuario solo puede aparecer una vez por UPSERT: gana su última versión
+        batch = {user_id: row}
+        deadline = time.monotonic() + HISTORY_FLUSH_INTERVAL
+        while len(batch) < HISTORY_BATCH_MAX:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = history_write_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is HISTORY_WRITER_STOP:
+                stopping = True
+                break
+            user_id, row = item
+            batch[user_id] = row
+        flush_history_batch(list(batch.values()))
+
+history_writer_thread = threading.Thread(target=history_writer_loop, daemon=True)
+
+def close_db():
+    """Al apagar: detiene el escritor, escribe lo que quede en la cola y cierra el pool."""
+    # El escritor termina su lote en curso antes de salir; hasta entonces no se cierra el pool
+    if history_writer_thread.is_alive():
+        history_write_queue.put(HISTORY_WRITER_STOP)
+        history_writer_thread.join()
+    # Lo que haya quedado detrás de la señal de parada (o todo, si el escritor no corría)
+    batch = {}
+    while True:
+        try:
+            item = history_write_queue.get_nowait()
+        except queue.Empty:
+            break
+        if item is not HISTORY_WRITER_STOP:
+            user_id, row = item
+            batch[user_id] = row
+    if batch:
+        flush_history_batch(list(batch.values()))
+    db_pool.closeall()
+    logging.info("Pool de Postgres cerrado.")
 
 # --- INICIO: NUEVO SISTEMA DE CLIENTES ACTIVOS (LOCAL) ---
 ACTIVE_CLIENTS_FILE = "users.txt"
-ACTIVE_CLIENTS_LIST = set()
-active_clients_lock = threading.Lock()
+# frozenset inmutable: el hilo actualizador publica uno nuevo reasignando la variable
+# (asignación atómica), así /chat lo consulta sin tomar ningún lock
+ACTIVE_CLIENTS_LIST = frozenset()
+active_clients_mtime = None
+# Valor de active_clients_mtime mientras falta el archivo: solo se avisa al desaparecer
+ACTIVE_CLIENTS_FILE_MISSING = -1
+# Revisar el archivo solo cuesta un os.stat() mientras no cambie
+ACTIVE_CLIENTS_POLL_INTERVAL = 10  # segundos
 
 def fetch_active_clients():
     """Obtiene la lista de clientes activos desde el archivo local users.txt."""
+    global ACTIVE_CLIENTS_LIST, active_clients_mtime
     try:
+        # Si el archivo no cambió desde la última lectura no hace falta volver a parsearlo
+        mtime = os.stat(ACTIVE_CLIENTS_FILE).st_mtime_ns
+        if mtime == active_clients_mtime:
+            return
         with open(ACTIVE_CLIENTS_FILE, 'r', encoding='utf-8') as f:
             # Lee todas las líneas, las limpia, y filtra las que están comentadas
-            clients_from_file = {
+            clients_from_file = frozenset(
                 line.strip() 
                 for line in f 
                 if line.strip() and not line.strip().startswith('//') and not line.strip().startswith('#')
-            }
-        
-        with active_clients_lock:
-            global ACTIVE_CLIENTS_LIST
-            if ACTIVE_CLIENTS_LIST != clients_from_file:
-                ACTIVE_CLIENTS_LIST = clients_from_file
-                logging.info(f"Lista de clientes activos actualizada desde '{ACTIVE_CLIENTS_FILE}'. Total: {len(ACTIVE_CLIENTS_LIST)} clientes.")
+            )
+        active_clients_mtime = mtime
+
+        if ACTIVE_CLIENTS_LIST != clients_from_file:
+            ACTIVE_CLIENTS_LIST = clients_from_file
+            logging.info(f"Lista de clientes activos actualizada desde '{ACTIVE_CLIENTS_FILE}'. Total: {len(ACTIVE_CLIENTS_LIST)} clientes.")
     except FileNotFoundError:
-        logging.warning(f"El archivo '{ACTIVE_CLIENTS_FILE}' no fue encontrado. Ningún cliente estará activo.")
-        with active_clients_lock:
-            ACTIVE_CLIENTS_LIST = set()
+        if active_clients_mtime != ACTIVE_CLIENTS_FILE_MISSING:
+            logging.warning(f"El archivo '{ACTIVE_CLIENTS_FILE}' no fue encontrado. Ningún cliente estará activo.")
+        ACTIVE_CLIENTS_LIST = frozenset()
+        active_clients_mtime = ACTIVE_CLIENTS_FILE_MISSING
     except Exception as e:
         logging.error(f"No se pudo leer el archivo de clientes activos: {e}")
 
@@ -104,13 +384,18 @@ def update_active_clients_periodically():
     """Función que se ejecuta en un hilo para actualizar la lista periódicamente."""
     while True:
         fetch_active_clients()
-        time.sleep(300) # Actualiza cada 5 minutos
+        time.sleep(ACTIVE_CLIENTS_POLL_INTERVAL)
 # --- FIN: NUEVO SISTEMA DE CLIENTES ACTIVOS (LOCAL) ---
 
 
 # --- BLOQUEOS ---
-user_locks = {}
-locks_dict_lock = threading.Lock()
+# Número fijo de locks (potencia de 2); cada usuario cae siempre en el mismo.
+# Dos usuarios pueden compartir lock, pero la memoria ya no crece con cada user_id nuevo.
+USER_LOCK_STRIPES = 1024
+user_lock_stripes = [threading.Lock() for _ in range(USER_LOCK_STRIPES)]
+
+def user_lock(user_id):
+    return user_lock_stripes[hash(user_id) & (USER_LOCK_STRIPES - 1)]
 
 # --- EXPRESIONES ---
 EMOJI_PATTERN = re.compile("[" "\U0001F600-\U0001F64F"
@@ -118,10 +403,22 @@ EMOJI_PATTERN = re.compile("[" "\U0001F600-\U0001F64F"
     "\U0001F680-\U0001F6FF"
     "\U0001F1E0-\U0001F1FF" "]+", flags=re.UNICODE,
 )
-RANDOM_EMOJIS = [" 😉", " 😘", " 😊", " 🔥", " 😈", " 😏", " 🥺", " 💋", " ❤️", " 👀"]
+PUNCTUATION_PATTERN = re.compile(r'[?!.,;]')
+RANDOM_EMOJIS = (" 😉", " 😘", " 😊", " 🔥", " 😈", " 😏", " 🥺", " 💋", " ❤️", " 👀")
+# Respuestas de respaldo: tuplas de módulo para no reconstruir la lista en cada llamada
+IA_ERROR_REPLIES = ("amm no se q paso ahi", "jeeje fallo algo dime otra cosa", "uy no me salio q pena")
+REPEATED_REPLY_FALLBACKS = ("amm dime otra cosa", "jeeje cambiemos de tema", "q mas cuentas")
 
 # --- CONFIG BOT ---
 class BotConfig:
+    MAX_REPLY_WORDS = 8
+    # Mensajes (USER + CHATBOT) que se guardan en la DB y que se envían a Cohere
+    MAX_STORED_MESSAGES = 40
+    MAX_CONTEXT_MESSAGES = 20
+    # Se recorta por bloques para que el inicio del historial enviado (el prefijo del
+    # prompt) no cambie en cada turno y Cohere pueda reutilizar su cache de prompt
+    HISTORY_TRIM_STEP = 10
+
     FORBIDDEN_WORDS = [
         "sexi", "hago", "facebook", "instagram", "whatsapp", "tiktok",
         "gustas", "gustaria", "gusto", "coincidencia", "regalo", "soy"
@@ -164,6 +461,20 @@ Sé coqueta, juguetona, natural y un poco atrevida.
         ]
     }
 
+# Autómatas Aho-Corasick: una sola pasada sobre el texto en minúsculas encuentra
+# cualquier disparador / palabra prohibida, sin importar cuántos haya
+# Cada trigger guarda su posición en PREDEFINED_RESPONSES: si el mensaje contiene
+# varios, gana el que va antes en el diccionario (los genéricos como "hola" van al final)
+SYSTEM_TRIGGERS_AUTOMATON = ahocorasick.Automaton()
+for priority, (trigger, responses) in enumerate(BotConfig.PREDEFINED_RESPONSES.items()):
+    SYSTEM_TRIGGERS_AUTOMATON.add_word(trigger, (priority, trigger, responses))
+SYSTEM_TRIGGERS_AUTOMATON.make_automaton()
+
+FORBIDDEN_WORDS_AUTOMATON = ahocorasick.Automaton()
+for word in BotConfig.FORBIDDEN_WORDS:
+    FORBIDDEN_WORDS_AUTOMATON.add_word(word, word)
+FORBIDDEN_WORDS_AUTOMATON.make_automaton()
+
 # --- FUNCIONES AUX ---
 def contains_emoji(text): 
     return EMOJI_PATTERN.search(text) is not None
@@ -171,100 +482,245 @@ def contains_emoji(text):
 def strip_emojis(text): 
     return EMOJI_PATTERN.sub(r"", text).strip()
 
+def trim_history(history, limit):
+    """Deja como máximo `limit` mensajes, quitando del inicio bloques de HISTORY_TRIM_STEP."""
+    overflow = len(history) - limit
+    if overflow <= 0:
+        return history
+    step = BotConfig.HISTORY_TRIM_STEP
+    return history[-(-overflow // step) * step:]
+
 def get_user_history(user_id):
-    default = {"history": [], "emoji_last_message": False}
-    conn = get_db_connection()
-    try:
+    """Devuelve la sesión desde la cache o, si no está, desde Postgres."""
+    cached = get_cached_session(user_id)
+    if cached is not None:
+        return cached
+
+    session_data = {"history": [], "emoji_last_message": False}
+    with db_conn() as conn:
         with conn.cursor() as cur:
-            cur.execute("SELECT history, emoji_last_message FROM conversation_histories WHERE user_id = %s;", (user_id,))
+            # Se prepara una vez por conexión (no en el pool: la tabla puede no existir
+            # aún); un PREPARE no se deshace con el rollback del checkout
+            if not conn.get_hist_prepared:
+                cur.execute("""
+                    PREPARE get_hist (varchar) AS
+                    SELECT history, emoji_last_message FROM conversation_histories WHERE user_id = $1;
+                """)
+                conn.get_hist_prepared = True
+            cur.execute("EXECUTE get_hist (%s);", (user_id,))
             r = cur.fetchone()
             if r:
                 history, emoji_last = r
-                return {"history": history, "emoji_last_message": emoji_last}
-            return default
-    finally:
-        conn.close()
+                session_data = {"history": history, "emoji_last_message": emoji_last}
+
+    # Se guarda en memoria para que el siguiente acceso (p. ej. append_turn) no vuelva
+    # a la DB; solo si no hay ya una versión más nueva guardada mientras se leía
+    with session_cache_lock:
+        if user_id not in session_cache and user_id not in pending_history_rows:
+            session_cache[user_id] = session_data
+    return copy_session(session_data)
 
 def save_user_history(user_id, session_data):
-    conn = get_db_connection()
-    try:
-        with conn.cursor() as cur:
-            cur.execute("""
-                INSERT INTO conversation_histories (user_id, history, emoji_last_message)
-                VALUES (%s, %s, %s)
-                ON CONFLICT (user_id)
-                DO UPDATE SET history = EXCLUDED.history,
-                              emoji_last_message = EXCLUDED.emoji_last_message;
-            """, (user_id, json.dumps(session_data["history"]), session_data["emoji_last_message"]))
-            conn.commit()
-    finally:
-        conn.close()
+    """
+    Actualiza la cache al momento (el siguiente turno ya la ve) y deja la
+    escritura en Postgres en la cola del escritor en lote.
+    """
+    # Solo se conservan los últimos mensajes para que el JSONB no crezca sin límite
+    session_data["history"] = trim_history(session_data["history"], BotConfig.MAX_STORED_MESSAGES)
+    cache_session(user_id, session_data)
+    row = (user_id, orjson.dumps(session_data["history"]).decode(), session_data["emoji_last_message"])
+    with session_cache_lock:
+        pending_history_rows[user_id] = row
+    history_write_queue.put((user_id, row))
 
 def contains_forbidden_word(text):
-    return any(word in text.lower() for word in BotConfig.FORBIDDEN_WORDS)
+    return next(FORBIDDEN_WORDS_AUTOMATON.iter(text.lower()), None) is not None
 
 def handle_system_message(message):
-    for trigger, responses in BotConfig.PREDEFINED_RESPONSES.items():
-        if trigger in message.lower():
-            logging.info(f"SYSTEM_TRIGGER: '{trigger}' detectado → Respuesta predefinida.")
-            return random.choice(responses)
+    match = min((value for _, value in SYSTEM_TRIGGERS_AUTOMATON.iter(message.lower())), default=None)
+    if match:
+        _, trigger, responses = match
+        logging.info(f"SYSTEM_TRIGGER: '{trigger}' detectado → Respuesta predefinida.")
+        return random.choice(responses)
     return None
 
+# Un único hilo anota los turnos predefinidos, en vez de crear uno por petición:
+# al ser FIFO, dos turnos seguidos del mismo usuario se guardan en el orden en que llegaron
+system_turn_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="system-turn")
+
+def append_turn(user_id, user_message, reply, emoji_last_message=None):
+    """
+    Añade un turno (mensaje + respuesta) a la versión más reciente del historial.
+    Es lo único que corre bajo el lock del usuario: así dos turnos que terminan
+    a la vez no se pisan, sin bloquear al usuario mientras se espera a Cohere.
+    """
+    with user_lock(user_id):
+        user_session = get_user_history(user_id)
+        user_session["history"].append({"role": "USER", "message": user_message})
+        user_session["history"].append({"role": "CHATBOT", "message": reply})
+        if emoji_last_message is not None:
+            user_session["emoji_last_message"] = emoji_last_message
+        save_user_history(user_id, user_session)
+
+def record_system_turn(user_id, user_message, system_response):
+    """Anota en el historial un turno que se contestó con una respuesta predefinida."""
+    try:
+        append_turn(user_id, user_message, system_response, contains_emoji(system_response))
+    except Exception as e:
+        logging.error(f"No se pudo guardar el turno predefinido de '{user_id}': {e}", exc_info=True)
+
 # --- IA ---
+# Cache de respuestas: mensaje normalizado + historial e instrucciones enviados → últimas
+# respuestas distintas que dio Cohere. Solo se sirve desde la cache cuando ya hay
+# varias variantes, para que la misma pregunta no reciba siempre la misma respuesta.
+LLM_CACHE_SIZE = 20_000
+LLM_CACHE_TTL = 3600
+LLM_CACHE_MAX_VARIANTS = 8
+LLM_CACHE_MIN_VARIANTS = 3
+llm_cache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+llm_cache_lock = threading.Lock()
+
+def normalize_message(text):
+    """Minúsculas y sin tildes: 'Cuántos' y 'cuantos' dan la misma clave."""
+    decomposed = unicodedata.normalize("NFKD", text.lower().strip())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def llm_cache_key(instrucciones_sistema, user_message, cohere_history):
+    """Clave de la cache de respuestas.
+
+    Incluye todo lo que se envía a Cohere: una respuesta solo se reutiliza en una
+    conversación idéntica, así lo que un usuario contó nunca llega a otro.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(orjson.dumps([instrucciones_sistema, cohere_history]))
+    digest.update(normalize_message(user_message).encode())
+    return digest.hexdigest()
+
+def get_cached_ia_replies(key):
+    with llm_cache_lock:
+        cached = llm_cache.get(key)
+        if cached is not None:
+            return list(cached)
+    if redis_client is None:
+        return []
+    try:
+        raw = redis_client.lrange(f"llm:{key}", 0, -1)
+    except redis.RedisError as e:
+        logging.warning(f"No se pudo leer la respuesta IA de Redis: {e}")
+        return []
+    replies = [r.decode("utf-8") for r in reversed(raw)]
+    if replies:
+        with llm_cache_lock:
+            llm_cache[key] = deque(replies, maxlen=LLM_CACHE_MAX_VARIANTS)
+    return replies
+
+def cache_ia_reply(key, ia_reply):
+    with llm_cache_lock:
+        variants = llm_cache.get(key)
+        if variants is None:
+            variants = llm_cache[key] = deque(maxlen=LLM_CACHE_MAX_VARIANTS)
+        if ia_reply not in variants:
+            variants.append(ia_reply)
+    if redis_client is not None:
+        redis_key = f"llm:{key}"
+        try:
+            pipe = redis_client.pipeline()
+            pipe.lrem(redis_key, 0, ia_reply)
+            pipe.lpush(redis_key, ia_reply)
+            pipe.ltrim(redis_key, 0, LLM_CACHE_MAX_VARIANTS - 1)
+            pipe.expire(redis_key, LLM_CACHE_TTL)
+            pipe.execute()
+        except redis.RedisError as e:
+            logging.warning(f"No se pudo guardar la respuesta IA en Redis: {e}")
+
+def retry_after_seconds(error):
+    """Segundos de espera que pide Cohere en un 429 (cabecera Retry-After), si los manda."""
+    headers = getattr(error, "headers", None) or {}
+    try:
+        return max(0.0, float(headers.get("retry-after") or headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return None
+
+def stream_ia_reply(client, instrucciones_sistema, user_message, cohere_history):
+    """
+    Pide la respuesta a Cohere en streaming y deja de leer en cuanto ya hay
+    más palabras de las que se van a enviar, sin esperar al resto de tokens.
+    """
+    # En el primer turno no hay historial: se omite el campo en vez de mandar una lista vacía
+    history_kwargs = {"chat_history": cohere_history} if cohere_history else {}
+    stream = client.chat_stream(
+        model="command-a-03-2025",
+        preamble=instrucciones_sistema,
+        message=user_message,
+        temperature=1.1,
+        max_tokens=50,
+        **history_kwargs
+    )
+    parts = []
+    try:
+        for event in stream:
+            if event.event_type != "text-generation":
+                continue
+            parts.append(event.text)
+            if len(PUNCTUATION_PATTERN.sub('', "".join(parts)).split()) > BotConfig.MAX_REPLY_WORDS:
+                break
+    finally:
+        stream.close()
+    return "".join(parts).strip()
+
+def request_ia_reply(instrucciones_sistema, user_message, cohere_history):
+    """Obtiene la respuesta de Cohere, o de la cache si ese mensaje ya se respondió varias veces."""
+    cache_key = llm_cache_key(instrucciones_sistema, user_message, cohere_history)
+    cached_replies = get_cached_ia_replies(cache_key)
+    if len(cached_replies) >= LLM_CACHE_MIN_VARIANTS:
+        logging.info("LLM_CACHE: respuesta reutilizada, se omite la llamada a Cohere.")
+        return random.choice(cached_replies)
+
+    # Un intento con la siguiente llave y, si falla, otro con una llave distinta
+    failed_keys = []
+    for _ in range(2):
+        with key_manager.lease(exclude=failed_keys) as (index, client):
+            try:
+                started = time.monotonic()
+                ia_reply = stream_ia_reply(client, instrucciones_sistema, user_message, cohere_history)
+                key_manager.mark_success(index, time.monotonic() - started)
+                break
+            except NotFoundError:
+                return "ese modelo ya no esta jeeje"
+            except (UnauthorizedError, ForbiddenError):
+                key_manager.disable(index)
+                failed_keys.append(index)
+            except Exception as e:
+                logging.warning(f"Fallo la llamada a Cohere con la API key #{index + 1}: {e}")
+                key_manager.mark_failed(index, retry_after_seconds(e))
+                failed_keys.append(index)
+    else:
+        return random.choice(IA_ERROR_REPLIES)
+
+    # Solo se cachean respuestas reales de Cohere, nunca los mensajes de error
+    if ia_reply:
+        cache_ia_reply(cache_key, ia_reply)
+    return ia_reply
+
 def generate_ia_response(user_id, user_message, user_session):
     instrucciones_sistema = BotConfig.PREAMBULO_BASE
-    cohere_history = []
-
-    for msg in user_session.get("history", []):
-        role = "USER" if msg.get("role") == "USER" else "CHATBOT"
-        cohere_history.append({"role": role, "message": msg.get("message", "")})
+    # El historial ya se guarda con la forma que espera Cohere ({"role", "message"}),
+    # así que se envía tal cual en lugar de reconstruirlo en cada turno
+    cohere_history = trim_history(user_session["history"], BotConfig.MAX_CONTEXT_MESSAGES)
 
     last_bot_message = next((m["message"] for m in reversed(cohere_history) if m["role"] == "CHATBOT"), "")
 
-    ia_reply = ""
-    try:
-        client = key_manager.get_current_client()
-        response = client.chat(
-            model="command-a-03-2025",
-            preamble=instrucciones_sistema,
-            message=user_message,
-            chat_history=cohere_history,
-            temperature=1.1,
-            max_tokens=50
-        )
-        ia_reply = response.text.strip()
-    except NotFoundError:
-        ia_reply = "ese modelo ya no esta jeeje"
-    except Exception:
-        client = key_manager.rotate_to_next_key()
-        try:
-            response = client.chat(
-                model="command-a-03-2025",
-                preamble=instrucciones_sistema,
-                message=user_message,
-                chat_history=cohere_history,
-                temperature=1.1,
-                max_tokens=50
-            )
-            ia_reply = response.text.strip()
-        except Exception:
-            ia_reply = random.choice([
-                "amm no se q paso ahi",
-                "jeeje fallo algo dime otra cosa", 
-                "uy no me salio q pena"
-            ])
+    ia_reply = request_ia_reply(instrucciones_sistema, user_message, cohere_history)
 
     # Post-proceso
-    ia_reply = re.sub(r'[?!.,;]', '', ia_reply)
+    ia_reply = PUNCTUATION_PATTERN.sub('', ia_reply)
     if ia_reply.lower() == last_bot_message.lower():
-        ia_reply = random.choice(["amm dime otra cosa", "jeeje cambiemos de tema", "q mas cuentas"])
+        ia_reply = random.choice(REPEATED_REPLY_FALLBACKS)
     if contains_forbidden_word(ia_reply):
         ia_reply = "amm mejor cambiemos de tema jeeje"
-    if len(ia_reply.split()) > 8:
-        ia_reply = ' '.join(ia_reply.split()[:8])
-
-    user_session["history"].append({"role": "USER", "message": user_message})
-    user_session["history"].append({"role": "CHATBOT", "message": ia_reply})
+    words = ia_reply.split()
+    if len(words) > BotConfig.MAX_REPLY_WORDS:
+        ia_reply = ' '.join(words[:BotConfig.MAX_REPLY_WORDS])
 
     return ia_reply
 
@@ -296,12 +752,32 @@ def track_device_usage(client_id, ip_address):
         # 4. Retornar conteo
         return len(active_ips)
 
+# --- PARSEO FLEXIBLE DEL CUERPO ---
+# literal_eval construye un AST completo: solo se usa con cuerpos de tamaño razonable
+LITERAL_EVAL_MAX_CHARS = 16_384
+
+def parse_python_style_body(text):
+    """
+    Lee cuerpos que llegan como dict de Python (comillas simples). Solo se
+    cambian las comillas y se pasa a orjson si no hay comillas dobles: si las
+    hay, el cambio podría convertir texto del mensaje en claves nuevas. En ese
+    caso (o si trae apóstrofes) se usa literal_eval.
+    """
+    if '"' not in text:
+        try:
+            return orjson.loads(text.replace("'", '"'))
+        except orjson.JSONDecodeError:
+            pass
+    if len(text) > LITERAL_EVAL_MAX_CHARS:
+        raise ValueError(f"Cuerpo demasiado grande para literal_eval ({len(text)} caracteres).")
+    return ast.literal_eval(text)
+
 # --- API ---
 app = Flask(__name__)
 
 @app.route("/")
 def health_check():
-    return json.dumps({
+    return orjson.dumps({
         "status": "active", 
         "service": "Tatiana Chatbot",
         "timestamp": datetime.utcnow().isoformat()
@@ -310,15 +786,17 @@ def health_check():
 @app.route("/chat", methods=["POST"])
 def handle_chat():
     try:
-        raw = request.get_data(as_text=True)
+        # orjson lee los bytes directamente; solo el respaldo necesita el texto decodificado
+        raw = request.get_data()
         
         data = None
         try:
-            data = json.loads(raw)
-        except json.JSONDecodeError:
-            logging.warning("Fallo el parseo de JSON, intentando un método más flexible (literal_eval)...")
+            data = orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            logging.warning("Fallo el parseo de JSON, intentando un método más flexible...")
+            raw = raw.decode("utf-8", errors="replace")
             try:
-                data = ast.literal_eval(raw)
+                data = parse_python_style_body(raw)
                 if not isinstance(data, dict):
                     raise ValueError("El resultado evaluado no es un diccionario.")
             except (ValueError, SyntaxError) as e:
@@ -333,10 +811,13 @@ def handle_chat():
         if not client_id:
             return "Error: Petición inválida (falta client_id) tele", 401
 
-        with active_clients_lock:
-            if client_id not in ACTIVE_CLIENTS_LIST:
-                logging.warning(f"Cliente '{client_id}' inactivo o no encontrado en users.txt.")
-                return "Error se ah detectado una cuenta de volet invalida  su bot y su cuenta de sugo será baneada en poco tiempo tele.", 403
+        # Validación barata antes de tomar cualquier lock
+        if not user_id or not user_message:
+            return "Error: faltan parámetros", 400
+
+        if client_id not in ACTIVE_CLIENTS_LIST:
+            logging.warning(f"Cliente '{client_id}' inactivo o no encontrado en users.txt.")
+            return "Error se ah detectado una cuenta de volet invalida  su bot y su cuenta de sugo será baneada en poco tiempo tele.", 403
         
         # --- MONITOREO DE DISPOSITIVOS ---
         # Obtenemos la IP de quien hace la petición
@@ -346,34 +827,29 @@ def handle_chat():
         # ---------------------------------
 
         # --- FIN: NUEVA VERIFICACIÓN DE LICENCIA (LOCAL) ---
-        
-        if not user_id or not user_message:
-            return "Error: faltan parámetros", 400
-        
-        with locks_dict_lock:
-            if user_id not in user_locks:
-                user_locks[user_id] = threading.Lock()
-            lock = user_locks[user_id]
-
-        with lock:
-            user_session = get_user_history(user_id)
-
-            system_response = handle_system_message(user_message)
-            if system_response:
-                user_session["history"].append({"role": "USER", "message": user_message})
-                user_session["history"].append({"role": "CHATBOT", "message": system_response})
-                user_session["emoji_last_message"] = contains_emoji(system_response)
-                save_user_history(user_id, user_session)
-                return system_response
-
-            ia_reply = generate_ia_response(user_id, user_message, user_session)
-            save_user_history(user_id, user_session)
-            return ia_reply
+
+        # Las respuestas predefinidas se devuelven sin tocar el historial ni la DB;
+        # el turno se anota en segundo plano
+        system_response = handle_system_message(user_message)
+        if system_response:
+            system_turn_executor.submit(record_system_turn, user_id, user_message, system_response)
+            return system_response
+
+        # La llamada a Cohere trabaja sobre una copia del historial y no retiene el
+        # lock del usuario; el turno se anota al final sobre la versión más reciente
+        user_session = get_user_history(user_id)
+        ia_reply = generate_ia_response(user_id, user_message, user_session)
+        append_turn(user_id, user_message, ia_reply)
+        return ia_reply
 
     except Exception as e:
         logging.error(f"Error en /chat: {e}", exc_info=True)
         return "Error en el servidor", 500
 
+def handle_sigterm(signum, frame):
+    logging.info("SIGTERM recibido, apagando el servidor...")
+    sys.exit(0)
+
 # --- INICIO ---
 if __name__ == "__main__":
     init_db()
@@ -383,7 +859,14 @@ if __name__ == "__main__":
     update_thread = threading.Thread(target=update_active_clients_periodically, daemon=True)
     update_thread.start()
 
+    # --- ARRANCA EL ESCRITOR DE HISTORIALES EN LOTE ---
+    history_writer_thread.start()
+    atexit.register(close_db)
+    # Las plataformas apagan con SIGTERM: se convierte en SystemExit para que waitress
+    # se detenga limpiamente y se ejecute close_db
+    signal.signal(signal.SIGTERM, handle_sigterm)
+
     port = int(os.environ.get("PORT", 8080))
     logging.info(f"🚀 Servidor iniciado en puerto {port}")
-    serve(app, host="0.0.0.0", port=port, threads=20)
+    serve(app, host="0.0.0.0", port=port, threads=WAITRESS_THREADS)
     